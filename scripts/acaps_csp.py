@@ -4,16 +4,19 @@ dvfs_acaps_predictor.py
 Implementes the Simple Core State Predictor
 """
 
+import collections
+
 class Csp:
     def __init__(self, history_size=5, conf_th=3):
         self.history_size = history_size
-        self.history = [None] * history_size
+        self.history = collections.deque([None] * history_size, maxlen=history_size)
         self.conf = 0
         self.conf_th = conf_th
-        self.stats = {"Correct": 0.0, "Incorrect": 0.0}
+        self.correct = 0
+        self.incorrect = 0
 
     def update_history(self, value):
-        self.history.pop(0)
+        # The deque is bounded, so appending drops the oldest value
         self.history.append(value)
 
     def update_stats(self, prediction, actual):
@@ -22,9 +25,9 @@ class Csp:
             return
         
         if prediction == actual:
-            self.stats["Correct"] += 1
+            self.correct += 1
         else:
-            self.stats["Incorrect"] += 1
+            self.incorrect += 1
         
         # print(f"C: Actual: {actual}, Predicted: {prediction}")
 
@@ -55,4 +58,4 @@ class Csp:
         return False
 
     def get_stats(self):
-        return self.stats
+        return {"Correct": self.correct, "Incorrect": self.incorrect}
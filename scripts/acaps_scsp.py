@@ -22,7 +22,7 @@ Core state values:
 - NUM_STATES     7
 """
 
-import sys, os, sim, acaps_csp as acsp, csv
+import sys, os, sim, acaps_csp as acsp, csv, bisect
 
 class Scsp:
 
@@ -41,6 +41,9 @@ class Scsp:
     self.predictor_confidence = int(args.get(2, None) or 2)
 
     self.dvfs_table = self.build_dvfs_table(int(sim.config.get('power/technology_node')))
+    # Negate the (descending) frequencies so they can be searched with bisect
+    self.dvfs_neg_freqs = [-_f for _f, _v in self.dvfs_table]
+    self.dvfs_vdds = [_v for _f, _v in self.dvfs_table]
 
     self.flag = False
     sim.util.Every(self.calling_interval_ns * sim.util.Time.NS, self.periodic, roi_only = True)
@@ -49,15 +52,15 @@ class Scsp:
 
     self.config_freq_mhz = int(float(sim.config.get('perf_model/core/frequency'))*1e+3)
 
-    self.acsp = {}
-    self.avg_core_frequency = {}
-    self.avg_core_frequency_cont = {}
+    # Per-core state, indexed by core id
+    self.acsp = [acsp.Csp(history_size=1, conf_th = self.predictor_confidence) for _ in range(self.num_cores)]
+    self.freq_sum = [0.0] * self.num_cores
+    self.freq_samples = [0] * self.num_cores
 
-    # For each core create an predictor
-    for i in range(0, self.num_cores):
-      self.acsp[i] = acsp.Csp(history_size=1, conf_th = self.predictor_confidence)
-      self.avg_core_frequency[i] = 0.0
-      self.avg_core_frequency_cont[i] = 0.0
+    # Current frequency of each core as last read from or set by this script,
+    # and the core state at the time it was last read (None until the first read)
+    self.core_freq = [0.0] * self.num_cores
+    self.last_state = [None] * self.num_cores
 
     self.results_folder = sim.config.output_dir
     self.stats_file = sim.config.output_dir + "acaps_scsp_stats.csv"
@@ -71,22 +74,24 @@ class Scsp:
     if os.path.exists(self.stats_file):
         os.remove(self.stats_file)
 
-    with open(self.stats_file, 'w') as csvfile:
-      # Create a CSV writer object
-      csv_writer = csv.writer(csvfile)
-      
-      # Write the header to the CSV file
-      header = ["Time", "Core" , "Actual State", "Predicted State"]
-      csv_writer.writerow(header)
+    # Keep the stats file open for the whole run instead of reopening it per row
+    self.stats_flush_interval = 1024
+    self.stats_rows_since_flush = 0
+    self.stats_fp = open(self.stats_file, 'w', buffering=1 << 16)
+    self.stats_writer = csv.writer(self.stats_fp)
+
+    # Write the header to the CSV file
+    header = ["Time", "Core" , "Actual State", "Predicted State"]
+    self.stats_writer.writerow(header)
 
   def append_stats(self, data):
-    # Append data to an existing CSV file
-    with open(self.stats_file, 'a', ) as csvfile:
-        # Create a CSV writer object
-        csv_writer = csv.writer(csvfile)
-        
-        # Write the data to the CSV file
-        csv_writer.writerow(data)
+    # Append data to the open stats file, flushing every stats_flush_interval rows
+    self.stats_writer.writerow(data)
+
+    self.stats_rows_since_flush += 1
+    if self.stats_rows_since_flush >= self.stats_flush_interval:
+      self.stats_fp.flush()
+      self.stats_rows_since_flush = 0
   
   def adjust_frequency(self, core, state):
       new_freq = None
@@ -98,10 +103,18 @@ class Scsp:
       else:
         new_freq = self.config_freq_mhz
 
-      actual_freq = sim.dvfs.get_frequency(core)
+      # The cached frequency is only trusted while hook_cpufreq_change has not invalidated it
+      if (self.last_state[core] is None):
+        self.core_freq[core] = float(sim.dvfs.get_frequency(core))
 
-      if (actual_freq != new_freq):
+      if (self.core_freq[core] != new_freq):
         sim.dvfs.set_frequency(core, new_freq)
+        self.core_freq[core] = float(new_freq)
+
+  def hook_cpufreq_change(self, core):
+    # The frequency can also change outside this script (DVFS domains shared by several cores,
+    # SimSetFreq, other scripts): forget the cached frequencies so each core reads its own again
+    self.last_state[:] = [None] * self.num_cores
 
   def periodic(self, time, time_delta):
     # Don't do anythin on the first call 
@@ -115,16 +128,21 @@ class Scsp:
         print("Core %d is in IDLE state" % core)
       predictor = self.acsp[core]
 
-      # Calculate average frequency for each core
-      actual_freq = float(sim.dvfs.get_frequency(core))
-      self.avg_core_frequency_cont[core] += 1.0
-      self.avg_core_frequency[core] = ((self.avg_core_frequency_cont[core] - 1) * self.avg_core_frequency[core] + actual_freq) / self.avg_core_frequency_cont[core]
+      # Only ask the simulator for the frequency when the core changed state,
+      # otherwise it is still the one we last read or set
+      if (actual_state != self.last_state[core]):
+        self.last_state[core] = actual_state
+        self.core_freq[core] = float(sim.dvfs.get_frequency(core))
+
+      # Accumulate the frequency for the average reported at the end of the simulation
+      self.freq_sum[core] += self.core_freq[core]
+      self.freq_samples[core] += 1
       
+      # Get the old value
+      predicted_value = predictor.predict_next_value()
+
       # Reaction on the past prediction, to be read as was predictable.
       if predictor.is_predictable():
-        # Get the old value
-        predicted_value = predictor.predict_next_value()
-
         # Update predictor statistics
         predictor.update_stats(predicted_value, actual_state)
 
@@ -137,12 +155,13 @@ class Scsp:
         # self.append_stats(data)
 
       # Regular predictor updates
-      predictor.update(actual_state)
+      predictor.update_conf(predicted_value, actual_state)
+      predictor.update_history(actual_state)
 
-      # If enough confidence is present, predict the next state and adjust frequency.
-      if predictor.is_predictable():
-          predicted_state = predictor.predict_next_value()
-          self.adjust_frequency(core, predicted_state)
+      # If enough confidence is present, predict the next state (the one just seen) and adjust frequency.
+      # A misprediction resets the confidence, so only a correct prediction can leave the predictor confident.
+      if (predicted_value == actual_state) and predictor.is_predictable():
+          self.adjust_frequency(core, actual_state)
 
   def build_dvfs_table(self, tech):
     # Build a table of (frequency, voltage) pairs.
@@ -155,16 +174,22 @@ class Scsp:
       raise ValueError('No DVFS table available for %d nm technology node' % tech)
     
   def get_vdd_from_freq(self, f):
-    # Assume self.dvfs_table is sorted from highest frequency to lowest
-    for _f, _v in self.dvfs_table:
-      if f >= _f:
-        return _v
-    assert ValueError('Could not find a Vdd for invalid frequency %f' % f)
+    # Assume self.dvfs_table is sorted from highest frequency to lowest:
+    # the first entry with f >= _f is the first negated frequency >= -f
+    i = bisect.bisect_left(self.dvfs_neg_freqs, -f)
+    if i == len(self.dvfs_vdds):
+      raise ValueError('Could not find a Vdd for invalid frequency %f' % f)
+    return self.dvfs_vdds[i]
+
+  def get_avg_frequency(self, core):
+    if (self.freq_samples[core] == 0):
+      return 0.0
+    return self.freq_sum[core] / self.freq_samples[core]
 
   def power(self):
     outputbase = os.path.join(self.results_folder, 'dvfs_power')
 
-    freq = [ self.avg_core_frequency[core] for core in range(sim.config.ncores) ]
+    freq = [ self.get_avg_frequency(core) for core in range(sim.config.ncores) ]
     vdd = [ self.get_vdd_from_freq(f) for f in freq ]
     
     configfile = outputbase+'.cfg'
@@ -185,6 +210,8 @@ vdd[] = %s
     ))
 
   def hook_sim_end(self):
+    self.stats_fp.close()
+
     # Check if the file exists, and delete it if it does
     if os.path.exists(self.res_file):
         os.remove(self.res_file)
@@ -200,7 +227,7 @@ vdd[] = %s
       for core in range(0, self.num_cores):
         predictor = self.acsp[core]
         stats = predictor.get_stats()
-        avg_core_freq = int(self.avg_core_frequency[core])
+        avg_core_freq = int(self.get_avg_frequency(core))
 
         if (stats["Correct"] > 0):
           accuracy = (stats["Correct"] / (stats["Incorrect"] + stats["Correct"])) * 100.0
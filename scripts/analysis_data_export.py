@@ -38,55 +38,132 @@ Next steps:
 import sim
 import os
 import csv
+import array
+import collections
+
+# Write buffer for the CSV outputs
+CSV_BUFFER_SIZE = 1 << 20
+CSV_BATCH_SIZE = 4096           # rows buffered in memory before they are written out
+
+# Translation table from sampled state values to their ASCII digits
+STATE_DIGITS = bytes.maketrans(bytes(range(10)), b'0123456789')
+BOOL_BYTES = (b'False', b'True')
+
+
+class BranchEventRecord:
+    """Core states sampled after a single branch event"""
+    __slots__ = ('event_id', 'core_id', 'ip', 'branch_taken', 'start_time', 'instruction_count', 'first_sample', 'states',
+                 'idle_count', 'idle_position_sum')
+
+    def __init__(self, event_id, core_id, ip, branch_taken, start_time, instruction_count, first_sample):
+        self.event_id = event_id
+        self.core_id = core_id
+        self.ip = ip
+        self.branch_taken = branch_taken
+        self.start_time = start_time
+        self.instruction_count = instruction_count
+        self.first_sample = first_sample  # index of the record's first sample in the core's state timeline
+        self.states = None                # bytes of state values sliced from the timeline once the record closes
+        self.idle_count = 0               # IDLE samples in states
+        self.idle_position_sum = 0        # sum of the indices in states of those IDLE samples
 
 class CoreStateAnalyzer:
     """Individual core analyzer - one instance per core"""
-    def __init__(self, core_id, results_folder, observation_window, sampling_period):
+    def __init__(self, core_id, results_folder, observation_window, sampling_period, record_sink):
         self.core_id = core_id
         self.results_folder = results_folder
         self.observation_window = observation_window
         self.sampling_period = sampling_period
+        self.obs_window_fs = observation_window * sim.util.Time.US  # observation window in femtoseconds
         
-        self.active_records = {}        # key=event_id, value=record dict
-        self.completed_records = []     # store completed records in memory
+        self.active_records = collections.deque()  # active records, oldest first
+        self.record_sink = record_sink  # called with each record as soon as it completes
+        self.completed_count = 0
         self.next_event_id = 1         # track the next available event ID for this core
 
+        # All active records see the same samples, so they are stored once per core:
+        # state_timeline[i] is sample number timeline_base + i (a bytearray, so slices can be
+        # translated to text directly and trimming the front is cheap)
+        self.state_timeline = bytearray()
+        self.timeline_base = 0
+
+        # Running totals over the timeline, so a record's IDLE statistics are two subtractions:
+        # idle_prefix[i] counts the IDLE samples before state_timeline[i] and idle_sample_prefix[i]
+        # sums their sample numbers (only differences between entries are meaningful)
+        self.idle_prefix = array.array('q', [0])
+        self.idle_sample_prefix = array.array('q', [0])
+
     def record_branch_event(self, ip, predicted, actual, indirect):
         """Record a new branch event for this core."""
         event_id = self.next_event_id
         self.next_event_id += 1
         
-        record = {
-            'event_id': event_id,
-            'core_id': self.core_id,
-            'ip': ip,
-            'branch_taken': actual,
-            'start_time': sim.stats.time(),
-            'instruction_count': sim.stats.get('performance_model', self.core_id, 'instruction_count'),
-            'states': []
-        }
+        record = BranchEventRecord(
+            event_id,
+            self.core_id,
+            ip,
+            actual,
+            sim.stats.time(),
+            sim.stats.get('performance_model', self.core_id, 'instruction_count'),
+            self.timeline_base + len(self.state_timeline)
+        )
         
-        self.active_records[event_id] = record
+        self.active_records.append(record)
         #print(f"[DEBUG] Core {self.core_id}: New branch event {event_id} at IP {hex(ip)}")
 
     def collect_state_sample(self, time, time_delta):
         """Collect state samples for this core's active recording windows."""
-        if time_delta == 0:
+        active_records = self.active_records
+        if not active_records:
             return
 
+        timeline = self.state_timeline
+        idle_prefix = self.idle_prefix
+        idle_sample_prefix = self.idle_sample_prefix
         current_state = sim.dvfs.get_core_state(self.core_id)
-        
-        for event_id in list(self.active_records.keys()):
-            record = self.active_records[event_id]
-            elapsed_time = time - record['start_time']
-            
-            record['states'].append((elapsed_time, current_state))
-            
-            if elapsed_time > (self.observation_window * sim.util.Time.US):
-                self.completed_records.append(record)
-                del self.active_records[event_id]
-                # print("[DEBUG] Core %d: Completed record %d with %d states" % 
-                #       (self.core_id, event_id, len(record['states'])))
+        if current_state == 5:
+            idle_prefix.append(idle_prefix[-1] + 1)
+            idle_sample_prefix.append(idle_sample_prefix[-1] + self.timeline_base + len(timeline))
+        else:
+            idle_prefix.append(idle_prefix[-1])
+            idle_sample_prefix.append(idle_sample_prefix[-1])
+        timeline.append(current_state)
+        obs_window_fs = self.obs_window_fs
+
+        # Records are opened in time order, so the expired ones are always at the front
+        while active_records and time - active_records[0].start_time > obs_window_fs:
+            record = active_records.popleft()
+            self.close_record(record)
+            self.completed_count += 1
+            self.record_sink(record)
+            # print("[DEBUG] Core %d: Completed record %d with %d states" % 
+            #       (self.core_id, record.event_id, len(record.states)))
+
+        # Drop samples no active record needs any more, once they make up most of the timeline
+        if active_records:
+            unused = active_records[0].first_sample - self.timeline_base
+        else:
+            unused = len(timeline)
+        if unused > len(timeline) // 2:
+            del timeline[:unused]
+            del idle_prefix[:unused]
+            del idle_sample_prefix[:unused]
+            self.timeline_base += unused
+
+    def close_record(self, record):
+        """Fill in a record's states and IDLE statistics from the samples taken since it opened."""
+        start = record.first_sample - self.timeline_base
+        record.states = self.state_timeline[start:]
+        idle_count = self.idle_prefix[-1] - self.idle_prefix[start]
+        record.idle_count = idle_count
+        record.idle_position_sum = (self.idle_sample_prefix[-1] - self.idle_sample_prefix[start]
+                                    - record.first_sample * idle_count)
+
+    def close_active_records(self):
+        """Close the records still open and return them, oldest first."""
+        for record in self.active_records:
+            self.close_record(record)
+        return self.active_records
 
 class CoreStateAtBranchEventAnalyzer:
     def __init__(self):
@@ -96,7 +173,11 @@ class CoreStateAtBranchEventAnalyzer:
         self.observation_window = None  # Will be set in setup()
         self.sampling_period = None     # Will be set in setup()
         self.total_branches = 0
-        self.core_analyzers = {}
+        self.core_analyzers = []  # indexed by core_id
+        self.patterns_fp = None
+        self.row_buf = []               # state pattern rows not yet written out
+        self.total_records = 0
+        self.pattern_stats = {}         # key=ip, value=[count, idle_count, idle_position_sum, branch_taken_count]
 
     def setup(self, args):
         # Parse arguments similar to SCSP style
@@ -111,16 +192,23 @@ class CoreStateAtBranchEventAnalyzer:
         self.results_folder = sim.config.output_dir
         self.state_patterns_file = os.path.join(self.results_folder, "core_state_patterns.csv")
         self.analysis_summary_file = os.path.join(self.results_folder, "state_pattern_summary.csv")
+
+        # Keep the patterns file open for the whole run instead of reopening it per write
+        self.patterns_fp = open(self.state_patterns_file, 'wb', buffering=CSV_BUFFER_SIZE)
+        self.patterns_fp.write(b"Event_ID,Instruction_Count,Start_Time,Core_ID,Branch_IP,Branch_Taken,States\n")
         
         # Create analyzers for each core
         num_cores = sim.config.ncores
-        for core_id in range(num_cores):
-            self.core_analyzers[core_id] = CoreStateAnalyzer(
+        self.core_analyzers = [
+            CoreStateAnalyzer(
                 core_id, 
                 self.results_folder,
                 self.observation_window,
-                self.sampling_period
+                self.sampling_period,
+                self.record_completed
             )
+            for core_id in range(num_cores)
+        ]
         
         # Register branch prediction callback using EveryBranch
         def branch_callback(ip, predicted, actual, indirect, core_id):
@@ -142,77 +230,87 @@ class CoreStateAtBranchEventAnalyzer:
     # These methods will be automatically called by Sniper's hook system
     def hook_periodic(self, time, time_delta=0):
         """Periodic hook for state sampling - delegates to each core analyzer."""
-        for analyzer in self.core_analyzers.values():
+        # Also registered on the raw periodic hook (time_delta=0); only sample on the sim.util.Every calls
+        if time_delta == 0:
+            return
+
+        for analyzer in self.core_analyzers:
             analyzer.collect_state_sample(time, time_delta)
 
     def hook_branch_predictor(self, core_id, ip, predicted, actual, indirect):
         """Hook for branch events - delegates to appropriate core analyzer."""
         #print("[DEBUG] Branch event detected on core %d at IP %s" % (core_id, hex(ip)))  # Add debug print
         self.total_branches += 1
-        if core_id in self.core_analyzers:
-            self.core_analyzers[core_id].record_branch_event(ip, predicted, actual, indirect)
+        analyzers = self.core_analyzers
+        if 0 <= core_id < len(analyzers):
+            analyzers[core_id].record_branch_event(ip, predicted, actual, indirect)
 
     def hook_sim_end(self):
         """Simulation end hook - combines and writes results from all cores."""
-        all_completed_records = []
-        
-        # Collect remaining active records and all completed records
-        for analyzer in self.core_analyzers.values():
-            print(f"[DEBUG] Core {analyzer.core_id} has {len(analyzer.completed_records)} completed records and {len(analyzer.active_records)} active records")
-            all_completed_records.extend(analyzer.completed_records)
-            for record in analyzer.active_records.values():
-                all_completed_records.append(record)
-
-        print(f"[DEBUG] Writing {len(all_completed_records)} total records")
-
-        # Write all records to file
-        with open(self.state_patterns_file, 'w', newline='') as f:
-            f.write("Event_ID,Instruction_Count,Start_Time,Core_ID,Branch_IP,Branch_Taken,States\n")
-            for record in all_completed_records:
-                states_str = ','.join(str(s) for _, s in record['states'])
-                f.write(f"{record['event_id']},{record['instruction_count']},{record['start_time']},{record['core_id']},{hex(record['ip'])},{record['branch_taken']},{states_str}\n")
-
-        self.generate_analysis_summary(all_completed_records)
+        # Completed records have already been written; add the ones still active
+        for analyzer in self.core_analyzers:
+            print(f"[DEBUG] Core {analyzer.core_id} has {analyzer.completed_count} completed records and {len(analyzer.active_records)} active records")
+            for record in analyzer.close_active_records():
+                self.record_completed(record)
+
+        print(f"[DEBUG] Wrote {self.total_records} total records")
+
+        self.patterns_fp.writelines(self.row_buf)
+        self.row_buf.clear()
+        self.patterns_fp.close()
+        self.patterns_fp = None
+
+        self.generate_analysis_summary()
         print(f"[CORE_ANALYZER] Total branches encountered: {self.total_branches}")
 
-    def generate_analysis_summary(self, all_records):
-        """Generate statistical summary from all cores' records."""
-        pattern_stats = {}
-        total_records = len(all_records)
-
-        for record in all_records:
-            ip = hex(record['ip'])
-            branch_taken = record['branch_taken']
-            states = [s for _, s in record['states']]
-
-            idle_positions = [i for i, state in enumerate(states) if state == 5]
-
-            if idle_positions:
-                if ip not in pattern_stats:
-                    pattern_stats[ip] = {
-                        'count': 1,
-                        'idle_positions': idle_positions,
-                        'branch_taken_count': 1 if branch_taken else 0
-                    }
-                else:
-                    pattern_stats[ip]['count'] += 1
-                    pattern_stats[ip]['idle_positions'].extend(idle_positions)
-                    if branch_taken:
-                        pattern_stats[ip]['branch_taken_count'] += 1
+    def record_completed(self, record):
+        """Write out a completed record and fold it into the summary statistics; the record is not kept."""
+        self.export_state_sequence(record)
+        self.total_records += 1
+
+        if record.idle_count:
+            stats = self.pattern_stats.get(record.ip)
+            if stats is None:
+                stats = self.pattern_stats[record.ip] = [0, 0, 0, 0]
+            stats[0] += 1
+            stats[1] += record.idle_count
+            stats[2] += record.idle_position_sum
+            if record.branch_taken:
+                stats[3] += 1
+
+    def export_state_sequence(self, record):
+        """Queue one record for the state patterns file, writing rows out in batches of CSV_BATCH_SIZE."""
+        # States are single digits: translate the raw bytes to ASCII and interleave them with
+        # commas, giving ",s0,s1,..." (or a lone "," for the empty States column of a record with no samples)
+        states = record.states
+        if states:
+            states_bytes = bytearray(b',' * (2 * len(states)))
+            states_bytes[1::2] = states.translate(STATE_DIGITS)
+        else:
+            states_bytes = b','
+        self.row_buf.append(b"%d,%d,%d,%d,%#x,%s%s\n" % (record.event_id, record.instruction_count, record.start_time,
+                                                          record.core_id, record.ip, BOOL_BYTES[record.branch_taken], states_bytes))
+
+        if len(self.row_buf) >= CSV_BATCH_SIZE:
+            self.patterns_fp.writelines(self.row_buf)
+            self.row_buf.clear()
+
+    def generate_analysis_summary(self):
+        """Write the statistical summary accumulated from all cores' records."""
+        pattern_stats = self.pattern_stats
 
         # Write pattern summary
-        with open(self.analysis_summary_file, 'w', newline='') as f:
-            f.write("Branch_IP,Count,Avg_Idle_Position,Idle_Time_Percent,Branch_Taken_Ratio\n")
-            for ip, stats in pattern_stats.items():
-                count = stats['count']
-                idle_positions = stats['idle_positions']
-                avg_position = sum(idle_positions) / len(idle_positions)
+        with open(self.analysis_summary_file, 'w', newline='', buffering=CSV_BUFFER_SIZE) as f:
+            lines = ["Branch_IP,Count,Avg_Idle_Position,Idle_Time_Percent,Branch_Taken_Ratio\n"]
+            for ip, (count, idle_count, idle_position_sum, branch_taken_count) in pattern_stats.items():
+                avg_position = idle_position_sum / idle_count
                 total_samples_per_record = self.observation_window
-                idle_percentage = (len(idle_positions) / (count * total_samples_per_record)) * 100
-                branch_taken_ratio = stats['branch_taken_count'] / count
-                f.write(f"{ip},{count},{avg_position:.2f},{idle_percentage:.2f},{branch_taken_ratio:.2f}\n")
+                idle_percentage = (idle_count / (count * total_samples_per_record)) * 100
+                branch_taken_ratio = branch_taken_count / count
+                lines.append(f"{ip:#x},{count},{avg_position:.2f},{idle_percentage:.2f},{branch_taken_ratio:.2f}\n")
+            f.writelines(lines)
 
-        print(f"[CORE_ANALYZER] Analyzed {total_records} total records")
+        print(f"[CORE_ANALYZER] Analyzed {self.total_records} total records")
         print(f"[CORE_ANALYZER] Found {len(pattern_stats)} branches with IDLE states")
 
 # Register the analyzer
@@ -24,21 +24,18 @@ class BranchMarkovPredictor:
         self.taken_count = 0
         self.not_taken_count = 0
         sim.util.EveryBranch(self.handle_branch)
+        # Progress is reported from a periodic callback so the branch hook stays minimal
+        sim.util.Every(1 * sim.util.Time.MS, self.print_progress)
 
     def handle_branch(self, ip, predicted, actual, indirect, core_id):
         self.branch_count += 1
-        if actual:
-            self.taken_count += 1
-        else:
-            self.not_taken_count += 1
-            
-        if self.branch_count % 1000 == 0:  # Print periodically
-            print(f"[BRANCH_MARKOV] Branch #{self.branch_count}")
-            print(f"  IP: {hex(ip)}")
-            print(f"  Predicted: {predicted}, Actual: {actual}")
-            print(f"  {'Correct!' if predicted == actual else 'Incorrect'}")
+        self.taken_count += actual  # not-taken branches are counted at the end
+
+    def print_progress(self, time, time_delta):
+        print(f"[BRANCH_MARKOV] {self.branch_count} branches, {self.taken_count} taken")
 
     def hook_sim_end(self):
+        self.not_taken_count = self.branch_count - self.taken_count
         print("\n[BRANCH_MARKOV] Final Statistics:")
         print(f"Total branches encountered: {self.branch_count}")
         print(f"Taken branches: {self.taken_count} ({self.taken_count/self.branch_count*100:.2f}%)")
@@ -1,7 +1,16 @@
 import sim
 import os
 import csv
+import collections
 
+# Write buffer for the CSV outputs: the core states stream to disk during the run, the rest is written at the end
+CSV_BUFFER_SIZE = 1 << 20
+CSV_BATCH_SIZE = 4096           # rows formatted and written per write() / writerows() call
+
+# Core state and branch rows skip the csv module: they are %-formatted to bytes, ending in
+# \r\n like csv.writer's rows so the files stay compatible.
+# CSV text of a bool, indexed by the bool
+BOOL_BYTES = (b'False', b'True')
 
 CORE_STATE_LABELS = {
     0: 'RUNNING',
@@ -16,24 +25,46 @@ CORE_STATE_LABELS = {
 def is_idle(state_id):
     return (state_id == 5)
 
+# Branch states (ip, taken) are packed into one int as (ip << 1) | taken, and a
+# transition into (prev_state << BRANCH_STATE_BITS) | curr_state (64-bit IPs + taken bit)
+BRANCH_STATE_BITS = 65
+BRANCH_STATE_MASK = (1 << BRANCH_STATE_BITS) - 1
+
+class HexIpCache(dict):
+    """hex() of branch IPs, formatted once per distinct IP on first lookup."""
+    def __missing__(self, ip):
+        ip_hex = self[ip] = hex(ip)
+        return ip_hex
+
 class MarkovChainPredictor:
     """
     A simple Markov chain predictor for idle vs. active states based on
     consecutive branch states. Each transition is keyed by:
       ( (ip_prev, taken_prev), (ip_curr, taken_curr) )
-    and stores how many times these transitions were observed and
+    packed into a single int (see BRANCH_STATE_BITS), and stores how many times these transitions were observed and
     how many led to an idle state in between.
     """
 
-    def __init__(self):
+    def __init__(self, num_cores):
         # Transition stats for Markov chain:
-        #   key: ((ip_prev, taken_prev), (ip_curr, taken_curr))
-        #   val: {'count': int, 'idle_count': int}
-        self.transition_stats = {}
+        #   key: packed ((ip_prev, taken_prev), (ip_curr, taken_curr))
+        #   val: how many times the transition was seen / how many saw an idle state
+        self.transition_counts = collections.Counter()
+        self.transition_idle_counts = collections.Counter()
+
+        # Same counts summed over all transitions leaving a branch state:
+        #   key: packed (ip_prev, taken_prev)
+        self.prev_state_counts = collections.Counter()
+        self.prev_state_idle_counts = collections.Counter()
+
+        # Transitions recorded by update_chain but not yet added to the counters
+        # above (see flush_transitions); the idle list holds the idle ones again
+        self.pending_transitions = []
+        self.pending_idle_transitions = []
 
-        # Last branch state per core for chaining:
-        #   core_id -> (ip, taken)
-        self.last_branch_state = {}
+        # Last branch state per core for chaining, indexed by core_id:
+        #   packed (ip, taken), or None before the core's first branch
+        self.last_branch_state = [None] * num_cores
 
         # Log of predictions (for offline analysis):
         #   Each item: {
@@ -55,69 +86,75 @@ class MarkovChainPredictor:
         self.num_predictions_idle = 0
         self.num_predictions_active = 0
 
-    def update_chain(self, core_id, branch_state, encountered_states):
+    def update_chain(self, core_id, ip, taken, idle_observed):
         """
         Update the Markov chain with a new branch transition for the specified core.
 
         :param core_id: The core on which the branch occurred
-        :param branch_state: Tuple (ip, taken) for this new branch
-        :param encountered_states: List of state IDs observed since the last branch
+        :param ip: Address of this new branch
+        :param taken: Whether this new branch was taken
+        :param idle_observed: Whether an IDLE state was sampled on the core since the last branch
         """
         # Count how many times branches are taken vs. not taken
-        _, taken_flag = branch_state
-        if taken_flag:
+        if taken:
             self.branches_taken += 1
+            branch_state = (ip << 1) | 1
         else:
             self.branches_not_taken += 1
+            branch_state = ip << 1
 
-        # If no last branch state, record this one and return
-        if core_id not in self.last_branch_state:
-            self.last_branch_state[core_id] = branch_state
+        # Make this the core's last branch; on its first branch there is nothing to chain
+        last_branch_state = self.last_branch_state
+        prev_branch_state = last_branch_state[core_id]
+        last_branch_state[core_id] = branch_state
+        if prev_branch_state is None:
             return
 
-        prev_branch_state = self.last_branch_state[core_id]
-        self.last_branch_state[core_id] = branch_state
-
-        # Build Markov chain key and record the idle or not-idle
-        key = (prev_branch_state, branch_state)
-        idle_observed = any(is_idle(s) for s in encountered_states)
-
-        if key not in self.transition_stats:
-            self.transition_stats[key] = {
-                'count': 0,
-                'idle_count': 0
-            }
-
-        self.transition_stats[key]['count'] += 1
+        # Build Markov chain key and record the idle or not-idle; the counters
+        # are only updated in bulk by flush_transitions
+        key = (prev_branch_state << BRANCH_STATE_BITS) | branch_state
+        self.pending_transitions.append(key)
         if idle_observed:
-            self.transition_stats[key]['idle_count'] += 1
+            self.pending_idle_transitions.append(key)
+
+    def flush_transitions(self):
+        """
+        Add the transitions buffered by update_chain to the transition counters.
+        Must be called before the counters are read (predict_idle, dumps).
+        """
+        pending = self.pending_transitions
+        if pending:
+            self.transition_counts.update(pending)
+            self.prev_state_counts.update([key >> BRANCH_STATE_BITS for key in pending])
+            pending.clear()
+
+        pending_idle = self.pending_idle_transitions
+        if pending_idle:
+            self.transition_idle_counts.update(pending_idle)
+            self.prev_state_idle_counts.update([key >> BRANCH_STATE_BITS for key in pending_idle])
+            pending_idle.clear()
 
     def predict_idle(self, core_id):
         """
         Predict whether the core is likely to go idle next time.
         Summarize all transitions from the last known branch state for this core.
+        Only transitions already added by flush_transitions are taken into account.
 
         :param core_id: The core for which we want to predict
         :return: True if predicted idle, False if active, or None if no data
         """
-        if core_id not in self.last_branch_state:
+        prev_state = self.last_branch_state[core_id]
+        if prev_state is None:
             return None
 
-        ip_taken_prev = self.last_branch_state[core_id]
-        total_count = 0
-        total_idle = 0
-
-        # Sum up transitions: (ip_taken_prev) -> ...
-        for (k_prev, k_curr), stats in self.transition_stats.items():
-            if k_prev == ip_taken_prev:
-                total_count += stats['count']
-                total_idle += stats['idle_count']
-
-        if total_count == 0:
+        # All transitions (ip_taken_prev) -> ..., summed as they are recorded
+        total_count = self.prev_state_counts.get(prev_state)
+        if total_count is None:
             return None
 
-        idle_prob = float(total_idle) / float(total_count)
-        return (idle_prob > 0.5)
+        # idle_prob = total_idle / total_count > 0.5, without the division
+        total_idle = self.prev_state_idle_counts.get(prev_state, 0)
+        return (total_idle * 2 > total_count)
 
     def log_prediction(self, event_id, core_id, predicted_idle, actual_idle):
         """
@@ -152,13 +189,12 @@ class MarkovChainPredictor:
 
         :param filepath: Where to write the CSV file
         """
-        with open(filepath, 'w', newline='') as csvfile:
+        with open(filepath, 'w', newline='', buffering=CSV_BUFFER_SIZE) as csvfile:
             writer = csv.DictWriter(csvfile, fieldnames=[
                 'event_id', 'core_id', 'predicted_idle', 'actual_idle'
             ])
             writer.writeheader()
-            for row in self.prediction_log:
-                writer.writerow(row)
+            writer.writerows(self.prediction_log)
 
     def dump_transition_stats(self, filepath):
         """
@@ -166,24 +202,31 @@ class MarkovChainPredictor:
 
         :param filepath: Where to write the CSV file
         """
-        with open(filepath, 'w', newline='') as csvfile:
+        with open(filepath, 'w', newline='', buffering=CSV_BUFFER_SIZE) as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow([
                 'Prev_IP', 'Prev_Taken', 'Next_IP', 'Next_Taken',
                 'Count', 'Idle_Count', 'Idle_Ratio'
             ])
-            for (prev_state, curr_state), stats in self.transition_stats.items():
-                (prev_ip, prev_taken) = prev_state
-                (curr_ip, curr_taken) = curr_state
-                count = stats['count']
-                idle_count = stats['idle_count']
+            self.flush_transitions()
+            idle_counts = self.transition_idle_counts
+            rows = []
+            ip_hex = HexIpCache()
+            for key, count in self.transition_counts.items():
+                prev_state = key >> BRANCH_STATE_BITS
+                curr_state = key & BRANCH_STATE_MASK
+                idle_count = idle_counts.get(key, 0)
                 ratio = float(idle_count) / count if count > 0 else 0.0
-                writer.writerow([
-                    hex(prev_ip), prev_taken,
-                    hex(curr_ip), curr_taken,
+                rows.append((
+                    ip_hex[prev_state >> 1], bool(prev_state & 1),
+                    ip_hex[curr_state >> 1], bool(curr_state & 1),
                     count, idle_count,
                     f"{ratio:.4f}"
-                ])
+                ))
+                if len(rows) >= CSV_BATCH_SIZE:
+                    writer.writerows(rows)
+                    rows.clear()
+            writer.writerows(rows)
 
     def dump_statistics(self, filepath):
         """
@@ -232,11 +275,16 @@ class CoreStateAndBranchMonitor:
         self.global_event_id = 1
         
         # Logs for states and branches
-        self.core_state_log = []  # (event_id, core_id, state_id, time_fs)
+        self.core_state_log = []  # (event_id, core_id, state_id, time_fs), not yet written
+        self.core_states_file = None
+        self.core_states_fp = None
         self.branch_log = []      # (event_id, core_id, ip, actual_taken, predicted_taken, indirect, time_fs)
 
-        # Our Markov chain predictor instance
-        self.markov_predictor = MarkovChainPredictor()
+        # Per core: 1 if an IDLE state was sampled since the last branch on that core (sized in setup)
+        self.idle_since_last_branch = bytearray()
+
+        # Our Markov chain predictor instance (created in setup, once ncores is known)
+        self.markov_predictor = None
 
     def setup(self, args):
         """
@@ -247,6 +295,13 @@ class CoreStateAndBranchMonitor:
         args = dict(enumerate((args or '').split(':')))
         self.sampling_period_us = int(args.get(0, None) or 1)
         self.results_folder = sim.config.output_dir
+        self.idle_since_last_branch = bytearray(sim.config.ncores)
+        self.markov_predictor = MarkovChainPredictor(sim.config.ncores)
+
+        # Core state samples are streamed to disk in batches rather than kept until the end
+        self.core_states_file = os.path.join(self.results_folder, "periodic_core_states.csv")
+        self.core_states_fp = open(self.core_states_file, 'wb', buffering=CSV_BUFFER_SIZE)
+        self.core_states_fp.write(b"event_id,core_id,state_id,time_fs\r\n")
 
         # Register periodic sampling
         self.periodic_hook = sim.util.Every(
@@ -270,31 +325,67 @@ class CoreStateAndBranchMonitor:
         if time_delta_fs == 0:
             return
 
+        # Count the branches seen since the last sample before predicting from them
+        self.markov_predictor.flush_transitions()
+
+        # Bind everything used per core to locals; the event counter is written back once
         num_cores = sim.config.ncores
-        for core_id in range(num_cores):
-            event_id = self.global_event_id
-            self.global_event_id += 1
+        get_core_state = sim.dvfs.get_core_state
+        log_core_state = self.core_state_log.append
+        idle_since_last_branch = self.idle_since_last_branch
+        predict_idle = self.markov_predictor.predict_idle
+        log_prediction = self.markov_predictor.log_prediction
+        event_id = self.global_event_id
 
-            state_id = sim.dvfs.get_core_state(core_id)
+        for core_id in range(num_cores):
+            state_id = get_core_state(core_id)
             
             # Log the current core state
-            self.core_state_log.append((event_id, core_id, state_id, time_fs))
+            log_core_state((event_id, core_id, state_id, time_fs))
 
             # Perform and log a Markov chain prediction
-            predicted_idle = self.markov_predictor.predict_idle(core_id)
-            actual_idle = is_idle(state_id)
-            self.markov_predictor.log_prediction(
+            predicted_idle = predict_idle(core_id)
+            actual_idle = (state_id == 5)    # IDLE
+            if actual_idle:
+                idle_since_last_branch[core_id] = 1
+            log_prediction(
                 event_id=event_id,
                 core_id=core_id,
                 predicted_idle=predicted_idle,
                 actual_idle=actual_idle
             )
+            event_id += 1
+
+        self.global_event_id = event_id
+
+        if len(self.core_state_log) >= CSV_BATCH_SIZE:
+            self.write_core_states()
+
+    def write_core_states(self):
+        """Write out the buffered core state samples."""
+        self.core_states_fp.write(b"".join([
+            b"%d,%d,%d,%d\r\n" % row for row in self.core_state_log
+        ]))
+        self.core_state_log.clear()
+
+    def write_branch_events(self, fp):
+        """Write the logged branch events to fp, a batch of rows per write."""
+        # %#x writes the IP as hex() would, without a temporary str per row
+        branch_log = self.branch_log
+        for start in range(0, len(branch_log), CSV_BATCH_SIZE):
+            fp.write(b"".join([
+                b"%d,%d,%#x,%s,%s,%s,%d\r\n" % (
+                    event_id, core_id, ip,
+                    BOOL_BYTES[actual], BOOL_BYTES[predicted], BOOL_BYTES[indirect], time_fs
+                )
+                for (event_id, core_id, ip, actual, predicted, indirect, time_fs) in branch_log[start:start + CSV_BATCH_SIZE]
+            ]))
 
     def hook_branch_predictor(self, core_id, ip, predicted, actual, indirect):
         """
         Called on every branch event. We increment global_event_id for each branch,
-        log the event, and update the Markov chain with the states encountered
-        since the last branch on this core.
+        log the event, and update the Markov chain with whether the core was seen
+        idle since the last branch on this core.
         """
         event_id = self.global_event_id
         self.global_event_id += 1
@@ -304,24 +395,14 @@ class CoreStateAndBranchMonitor:
             (event_id, core_id, ip, actual, predicted, indirect, time_fs)
         )
 
-        # Find the last branch event_id for this core
-        last_branch_id = None
-        for i in range(len(self.branch_log) - 2, -1, -1):
-            b_event_id, b_core, _, _, _, _, _ = self.branch_log[i]
-            if b_core == core_id:
-                last_branch_id = b_event_id
-                break
-
-        # Collect any core state IDs observed between that last branch and now
-        encountered_states = []
-        if last_branch_id is not None:
-            for (cid_event_id, cid_core, cid_state, _) in self.core_state_log:
-                if cid_core == core_id and last_branch_id < cid_event_id < event_id:
-                    encountered_states.append(cid_state)
+        # Whether an IDLE state was sampled on this core since its last branch. Before
+        # the first branch there is no transition yet and update_chain ignores it.
+        idle_since_last_branch = self.idle_since_last_branch
+        idle_observed = idle_since_last_branch[core_id]
+        idle_since_last_branch[core_id] = 0
 
         # Update Markov chain transitions
-        branch_state = (ip, actual)
-        self.markov_predictor.update_chain(core_id, branch_state, encountered_states)
+        self.markov_predictor.update_chain(core_id, ip, actual, idle_observed)
 
     def hook_sim_end(self):
         """
@@ -332,26 +413,16 @@ class CoreStateAndBranchMonitor:
           4) Markov chain prediction log
           5) Overall statistics (branches, predictions, accuracy, etc.)
         """
-        # 1) Core state samples
-        core_states_file = os.path.join(self.results_folder, "periodic_core_states.csv")
-        with open(core_states_file, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(["event_id", "core_id", "state_id", "time_fs"])
-            for (event_id, core_id, state_id, time_fs) in self.core_state_log:
-                writer.writerow([event_id, core_id, state_id, time_fs])
+        # 1) Core state samples (the rest was written during the simulation)
+        core_states_file = self.core_states_file
+        self.write_core_states()
+        self.core_states_fp.close()
 
         # 2) Branch events
         branch_file = os.path.join(self.results_folder, "branch_events.csv")
-        with open(branch_file, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                "event_id", "core_id", "ip",
-                "actual_taken", "predicted_taken", "indirect", "time_fs"
-            ])
-            for (event_id, core_id, ip, actual, predicted, indirect, time_fs) in self.branch_log:
-                writer.writerow([
-                    event_id, core_id, hex(ip), actual, predicted, indirect, time_fs
-                ])
+        with open(branch_file, 'wb', buffering=CSV_BUFFER_SIZE) as f:
+            f.write(b"event_id,core_id,ip,actual_taken,predicted_taken,indirect,time_fs\r\n")
+            self.write_branch_events(f)
 
         # 3) Markov chain transition stats
         transitions_file = os.path.join(self.results_folder, "markov_chain_transitions.csv")
@@ -1,6 +1,22 @@
 import sim
 import os
 import csv
+import array
+import struct
+import itertools
+
+# Write buffer for the CSV outputs
+CSV_BUFFER_SIZE = 1 << 20
+CSV_BATCH_SIZE = 4096           # rows buffered in memory before they are written out
+
+# Packed branch_log record: event_id, core_id, ip, actual_taken, predicted_taken, indirect, time_fs
+BRANCH_RECORD = struct.Struct('=qHq???q')
+BRANCH_LOG_BATCH_BYTES = CSV_BATCH_SIZE * BRANCH_RECORD.size
+
+# The fixed-layout rows are %-formatted straight to bytes rather than through the csv module,
+# with csv.writer's \r\n line ending so the files read the same.
+# CSV text of a bool, indexed by the bool (or a 0/1 flag byte)
+BOOL_BYTES = (b'False', b'True')
 
 CORE_STATE_LABELS = {
     0: 'RUNNING',
@@ -15,81 +31,91 @@ CORE_STATE_LABELS = {
 def is_idle(state_id):
     return (state_id == 5)
 
-class NbitPredictor:
-    """Individual core analyzer - one instance per core"""
-    def __init__(self, n_bits):
-        self.n_bits = n_bits
-        self.state = 0  # Initial state: 00 (Strongly Idle)
-        self.max_state = (1 << n_bits) - 1  # Max value for N-bit counter (2^n - 1)
-
-        # Log of predictions (for offline analysis):
-        #   Each item: {
-        #       'event_id': int,
-        #       'core_id': int,
-        #       'predicted_idle': bool or None,
-        #       'actual_idle': bool
-        #   }
-        self.prediction_log = []
-
-        # - how many predictions were made, how many correct, how many predicted idle/active
-        self.num_predictions_made = 0
-        self.num_predictions_correct = 0
-        self.num_predictions_idle = 0
-        self.num_predictions_active = 0
-
-    def update(self, event):
-        """Update the counter state based on the event (1 = Active, 0 = Idle)"""
-        if event == 1:  # Active
-            if self.state < self.max_state:
-                self.state += 1  # Increment the counter (up to the max value)
-        elif event == 0:  # Idle
-            if self.state > 0:
-                self.state -= 1  # Decrement the counter (down to 0)
-
-    def predict_idle(self):
-        """Return the predicted state: 1 for Active, 0 for Idle"""
-        return False if self.state >= (self.max_state // 2) else True
-
-    def log_prediction(self, event_id, core_id, predicted_idle, actual_idle):
-        # Update counters only if a real prediction was made (not None)
-        self.num_predictions_made += 1
-        if predicted_idle == actual_idle:
-            self.num_predictions_correct += 1
-        if predicted_idle is True:
-            self.num_predictions_idle += 1
-        else:
-            self.num_predictions_active += 1
-            
-        self.prediction_log.append({
-            'event_id': event_id,
-            'core_id': core_id,
-            'predicted_idle': predicted_idle,
-            'actual_idle': actual_idle
-        })
-
 class CoreStateAndBranchMonitor:
     def __init__(self):
         self.sampling_period = None
         self.results_folder = None
 
-        # A global counter for all events, both periodic and branch
-        self.global_event_id = 1
+        # A global counter for all events, both periodic and branch; a C-level
+        # itertools.count, so taking an ID needs no Python-level increment and store
+        self.event_id_counter = itertools.count(1)
+
+        # Fixed for the whole run, so looked up once in setup
+        self.num_cores = 0
+        self.core_ids = range(0)
 
-        # Logs for states and branches
-        self.core_state_log = []  # (event_id, core_id, state_id, time_fs)
-        self.branch_log = []      # (event_id, core_id, ip, actual_taken, predicted_taken, indirect, time_fs)
+        # Logs for states and branches, holding the rows not yet written out:
+        # - core state samples as columns of event_id, core_id, state_id (one byte) and time_fs
+        self.core_state_event_ids = array.array('q')
+        self.core_state_core_ids = array.array('H')
+        self.core_state_state_ids = bytearray()
+        self.core_state_times = array.array('q')
+        # - branch events
+        self.branch_log = bytearray()  # BRANCH_RECORD entries, back to back
+
+        # Output files: opened in setup and written a batch at a time during the simulation
+        self.core_states_file = None
+        self.core_states_fp = None
+        self.branch_file = None
+        self.branch_fp = None
+        self.predictions_file = None
+        self.predictions_fp = None
 
         # Track n-bit saturated counters
         self.n_bits = 2  # Default to 2-bit counter
-        
-        # Array of predictors for each core
-        self.nbit_predictors = {}
+        self.max_state = (1 << self.n_bits) - 1  # Max value for N-bit counter (2^n - 1)
+        self.idle_threshold = self.max_state // 2  # Counter values below this predict idle
+
+        # Saturating counter transitions, next_counter_state[idle][state] (built in setup)
+        self.next_counter_state = ()
+
+        # N-bit predictor of each core, as parallel lists indexed by core_id (sized in setup):
+        # - counter value, 0 (strongly idle) .. max_state (strongly active)
+        self.counter_state = []
+
+        # - how many predictions were made, how many correct, how many predicted idle/active
+        self.num_predictions_made = []
+        self.num_predictions_correct = []
+        self.num_predictions_idle = []
+        self.num_predictions_active = []
+
+        # Whether every prediction is logged to a file, or only counted per core
+        self.log_events = True
+
+        # Log of predictions not yet written out (for offline analysis), as columns:
+        # event and core IDs, and the predicted / actual idle flags (one byte each)
+        self.prediction_event_ids = array.array('q')
+        self.prediction_core_ids = array.array('H')
+        self.prediction_predicted_idle = bytearray()
+        self.prediction_actual_idle = bytearray()
 
     def setup(self, args):
         args = dict(enumerate((args or '').split(':')))
         self.sampling_period = int(args.get(0, None) or 1) # Default 1 us
         self.n_bits = int(args.get(1, None) or 2)  # Default 2-bit counter
+        self.log_events = bool(int(args.get(2, None) or 1))  # Default log every prediction
+        self.max_state = (1 << self.n_bits) - 1
+        self.idle_threshold = self.max_state // 2
+        # Active: increment (up to the max value); idle: decrement (down to 0)
+        self.next_counter_state = (
+            [min(state + 1, self.max_state) for state in range(self.max_state + 1)],
+            [max(state - 1, 0) for state in range(self.max_state + 1)]
+        )
         self.results_folder = sim.config.output_dir
+
+        # Open the outputs and write their headers
+        self.core_states_file = os.path.join(self.results_folder, "periodic_core_states.csv")
+        self.core_states_fp = open(self.core_states_file, 'wb', buffering=CSV_BUFFER_SIZE)
+        self.core_states_fp.write(b"event_id,core_id,state_id,time_fs\r\n")
+
+        self.branch_file = os.path.join(self.results_folder, "branch_events.csv")
+        self.branch_fp = open(self.branch_file, 'wb', buffering=CSV_BUFFER_SIZE)
+        self.branch_fp.write(b"event_id,core_id,ip,actual_taken,predicted_taken,indirect,time_fs\r\n")
+
+        if self.log_events:
+            self.predictions_file = os.path.join(self.results_folder, "nbit_counter_predictions.csv")
+            self.predictions_fp = open(self.predictions_file, 'wb', buffering=CSV_BUFFER_SIZE)
+            self.predictions_fp.write(b"event_id,core_id,predicted_idle,actual_idle\r\n")
         
         # Register periodic sampling
         self.periodic_hook = sim.util.Every(
@@ -97,19 +123,71 @@ class CoreStateAndBranchMonitor:
             lambda time, time_delta: self.hook_periodic(time, time_delta)
         )
 
-        # Register branch hook
+        # Register branch hook. It runs for every branch, so the callback records the event
+        # itself with everything it needs bound beforehand, instead of forwarding to a method
+        record_branch = self.branch_log.extend
+        pack_branch = BRANCH_RECORD.pack
+        get_time = sim.stats.time
+        next_event_id = self.event_id_counter.__next__
         def branch_callback(ip, predicted, actual, indirect, core_id):
-            self.hook_branch_predictor(core_id, ip, predicted, actual, indirect)
+            record_branch(pack_branch(next_event_id(), core_id, ip, actual, predicted, indirect, get_time()))
         self.branch_hook = sim.util.EveryBranch(branch_callback)
         
         # Initialize N-bit predictor for each core
-        num_cores = sim.config.ncores
-        for core_id in range(num_cores):
-            self.nbit_predictors[core_id] = NbitPredictor(self.n_bits)
+        num_cores = self.num_cores = sim.config.ncores
+        self.core_ids = range(num_cores)
+        self.counter_state = [0] * num_cores  # Initial state: 00 (Strongly Idle)
+        self.num_predictions_made = [0] * num_cores
+        self.num_predictions_correct = [0] * num_cores
+        self.num_predictions_idle = [0] * num_cores
+        self.num_predictions_active = [0] * num_cores
 
         print(f"[CORE_STATE_BRANCH_MONITOR] Setup complete.")
         print(f"[CORE_STATE_BRANCH_MONITOR] Sampling period [us]: {self.sampling_period}")
         print(f"[CORE_STATE_BRANCH_MONITOR] Registered n-bit saturated counter with {self.n_bits} bits")
+        print(f"[CORE_STATE_BRANCH_MONITOR] Logging every prediction: {self.log_events}")
+
+    def update_predictors(self, event_ids, state_ids):
+        """
+        Per-tick predictor kernel: in a single pass over the cores, update each core's
+        counter with its sampled state, predict from the new counter and count (and, with
+        log_events, log) the prediction.
+        """
+        log_events = self.log_events
+        idle_threshold = self.idle_threshold
+        next_counter_state = self.next_counter_state
+        counter_state = self.counter_state
+        num_predictions_made = self.num_predictions_made
+        num_predictions_correct = self.num_predictions_correct
+        num_predictions_idle = self.num_predictions_idle
+        num_predictions_active = self.num_predictions_active
+        prediction_predicted_idle = self.prediction_predicted_idle
+        prediction_actual_idle = self.prediction_actual_idle
+
+        for core_id, state_id in enumerate(state_ids):
+            actual_idle = (state_id == 5)    # IDLE
+
+            # Update the counter state by table lookup, without the saturation compares
+            state = counter_state[core_id] = next_counter_state[actual_idle][counter_state[core_id]]
+
+            # Predicted idle unless the counter is at least halfway up
+            predicted_idle = (state < idle_threshold)
+
+            num_predictions_made[core_id] += 1
+            if predicted_idle == actual_idle:
+                num_predictions_correct[core_id] += 1
+            if predicted_idle:
+                num_predictions_idle[core_id] += 1
+            else:
+                num_predictions_active[core_id] += 1
+
+            if log_events:
+                prediction_predicted_idle.append(predicted_idle)
+                prediction_actual_idle.append(actual_idle)
+
+        if log_events:
+            self.prediction_event_ids.extend(event_ids)
+            self.prediction_core_ids.extend(range(len(event_ids)))
 
     # These methods will be automatically called by Sniper's hook system
     def hook_periodic(self, time, time_delta=0):
@@ -117,99 +195,114 @@ class CoreStateAndBranchMonitor:
         if time_delta == 0:
             return
         
-        num_cores = sim.config.ncores
-        for core_id in range(num_cores):
-            event_id = self.global_event_id
-            self.global_event_id += 1
-
-            state_id = sim.dvfs.get_core_state(core_id)
-            
-            # Log the current core state
-            self.core_state_log.append((event_id, core_id, state_id, time))
-
-            # Update the N-bit predictor with the state of the core
-            self.nbit_predictors[core_id].update(1 if not is_idle(state_id) else 0)
-
-            predicted_idle = self.nbit_predictors[core_id].predict_idle()
-            actual_idle = is_idle(state_id)
-            self.nbit_predictors[core_id].log_prediction(
-                event_id=event_id,
-                core_id=core_id,
-                predicted_idle=predicted_idle,
-                actual_idle=actual_idle
+        num_cores = self.num_cores
+        core_ids = self.core_ids
+
+        # Sample all cores, then log the whole tick with one extend per column; each core gets the next event ID
+        get_core_state = sim.dvfs.get_core_state
+        state_ids = [get_core_state(core_id) for core_id in core_ids]
+        event_ids = list(itertools.islice(self.event_id_counter, num_cores))
+        self.core_state_event_ids.extend(event_ids)
+        self.core_state_core_ids.extend(core_ids)
+        self.core_state_state_ids.extend(state_ids)
+        self.core_state_times.extend(itertools.repeat(time, num_cores))
+
+        # Update the N-bit predictors with the states of the cores
+        self.update_predictors(event_ids, state_ids)
+
+        # Write out whatever has reached a full batch; the branch callback only buffers,
+        # its events are written from here
+        if len(self.core_state_state_ids) >= CSV_BATCH_SIZE:
+            self.write_core_states()
+        if len(self.prediction_actual_idle) >= CSV_BATCH_SIZE:
+            self.write_predictions()
+        if len(self.branch_log) >= BRANCH_LOG_BATCH_BYTES:
+            self.write_branch_events()
+
+    def write_core_states(self):
+        """Write out the buffered core state samples."""
+        self.core_states_fp.write(b"".join([
+            b"%d,%d,%d,%d\r\n" % row for row in zip(
+                self.core_state_event_ids, self.core_state_core_ids,
+                self.core_state_state_ids, self.core_state_times
             )
+        ]))
+        del self.core_state_event_ids[:]
+        del self.core_state_core_ids[:]
+        self.core_state_state_ids.clear()
+        del self.core_state_times[:]
 
-    def hook_branch_predictor(self, core_id, ip, predicted, actual, indirect):
-        event_id = self.global_event_id
-        self.global_event_id += 1
+    def write_branch_events(self):
+        """Write out the buffered branch events."""
+        # %#x writes the IP as hex() would, without a temporary str per row
+        self.branch_fp.write(b"".join([
+            b"%d,%d,%#x,%s,%s,%s,%d\r\n" % (
+                event_id, core_id, ip,
+                BOOL_BYTES[actual], BOOL_BYTES[predicted], BOOL_BYTES[indirect], time_fs
+            )
+            for (event_id, core_id, ip, actual, predicted, indirect, time_fs) in BRANCH_RECORD.iter_unpack(self.branch_log)
+        ]))
+        self.branch_log.clear()
 
-        time = sim.stats.time()
-        self.branch_log.append(
-            (event_id, core_id, ip, actual, predicted, indirect, time)
-        )
+    def write_predictions(self):
+        """Write out the buffered predictions."""
+        self.predictions_fp.write(b"".join([
+            b"%d,%d,%s,%s\r\n" % row for row in zip(
+                self.prediction_event_ids,
+                self.prediction_core_ids,
+                map(BOOL_BYTES.__getitem__, self.prediction_predicted_idle),
+                map(BOOL_BYTES.__getitem__, self.prediction_actual_idle)
+            )
+        ]))
+        del self.prediction_event_ids[:]
+        del self.prediction_core_ids[:]
+        self.prediction_predicted_idle.clear()
+        self.prediction_actual_idle.clear()
 
     def hook_sim_end(self):
-        # 1) Core state samples
-        core_states_file = os.path.join(self.results_folder, "periodic_core_states.csv")
-        with open(core_states_file, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow(["event_id", "core_id", "state_id", "time_fs"])
-            for (event_id, core_id, state_id, time_fs) in self.core_state_log:
-                writer.writerow([event_id, core_id, state_id, time_fs])
-
-        # 2) Branch events
-        branch_file = os.path.join(self.results_folder, "branch_events.csv")
-        with open(branch_file, 'w', newline='') as f:
-            writer = csv.writer(f)
-            writer.writerow([
-                "event_id", "core_id", "ip",
-                "actual_taken", "predicted_taken", "indirect", "time_fs"
-            ])
-            for (event_id, core_id, ip, actual, predicted, indirect, time_fs) in self.branch_log:
-                writer.writerow([
-                    event_id, core_id, hex(ip), actual, predicted, indirect, time_fs
-                ])
-
-        # 3) N-bit counter predictions for all cores
-        predictions_file = os.path.join(self.results_folder, "nbit_counter_predictions.csv")
-        with open(predictions_file, 'w', newline='') as csvfile:
-            writer = csv.DictWriter(csvfile, fieldnames=[
-                'event_id', 'core_id', 'predicted_idle', 'actual_idle'
-            ])
-            writer.writeheader()
-            num_cores = sim.config.ncores
-            for core_id in range(num_cores):
-                for row in self.nbit_predictors[core_id].prediction_log:
-                    writer.writerow(row)
+        # 1) Core state samples, 2) branch events and 3) N-bit counter predictions for all cores:
+        # write out the rest of each and close the files
+        self.write_core_states()
+        self.core_states_fp.close()
+        self.write_branch_events()
+        self.branch_fp.close()
+        if self.log_events:
+            self.write_predictions()
+            self.predictions_fp.close()
 
         # 4) Final statistics (branches taken/not, prediction accuracy, etc.) for all cores
         stats_file = os.path.join(self.results_folder, "nbit_counter_statistics.csv")
         with open(stats_file, 'w', newline='') as csvfile:
             writer = csv.writer(csvfile)
             writer.writerow(['Core_Id', 'Statistic', 'Value'])
-            writer.writerow("")
-
-            num_cores = sim.config.ncores
-            for core_id in range(num_cores):
+            writer.writerow([])  # blank separator row
 
-                # Prediction stats
-                writer.writerow([f"Core {core_id}", 'Predictions_Made', self.nbit_predictors[core_id].num_predictions_made])
-                writer.writerow([f"Core {core_id}", 'Predictions_Correct', self.nbit_predictors[core_id].num_predictions_correct])
+            # The per-core counters are already the totals: build every row, then write them at once
+            rows = []
+            for core_id, made, correct, idle, active in zip(
+                    self.core_ids, self.num_predictions_made, self.num_predictions_correct,
+                    self.num_predictions_idle, self.num_predictions_active):
+                core = f"Core {core_id}"
 
                 accuracy = 0.0
-                if self.nbit_predictors[core_id].num_predictions_made > 0:
-                    accuracy = (float(self.nbit_predictors[core_id].num_predictions_correct)
-                                / float(self.nbit_predictors[core_id].num_predictions_made)) * 100.0
-                writer.writerow([f"Core {core_id}", 'Accuracy_Percent', f"{accuracy:.2f}"])
+                if made > 0:
+                    accuracy = (float(correct) / float(made)) * 100.0
 
-                writer.writerow([f"Core {core_id}", 'Predictions_Idle', self.nbit_predictors[core_id].num_predictions_idle])
-                writer.writerow([f"Core {core_id}", 'Predictions_Active', self.nbit_predictors[core_id].num_predictions_active])
-                writer.writerow("")
+                rows += [
+                    [core, 'Predictions_Made', made],
+                    [core, 'Predictions_Correct', correct],
+                    [core, 'Accuracy_Percent', f"{accuracy:.2f}"],
+                    [core, 'Predictions_Idle', idle],
+                    [core, 'Predictions_Active', active],
+                    []  # blank separator row
+                ]
+            writer.writerows(rows)
 
         print("[CORE_STATE_BRANCH_MONITOR] Simulation ended. Data saved:")
-        print(f"  - {core_states_file}")
-        print(f"  - {branch_file}")
-        print(f"  - {predictions_file}")
+        print(f"  - {self.core_states_file}")
+        print(f"  - {self.branch_file}")
+        if self.log_events:
+            print(f"  - {self.predictions_file}")
         print(f"  - {stats_file}")     
 
 # Register the analyzer